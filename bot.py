@@ -1,57 +1,246 @@
 import asyncio
+import io
 import logging
 import os
 import re
-import sqlite3
-from contextlib import closing
-from datetime import datetime
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from html import escape
 from types import SimpleNamespace
 
-from aiogram import Bot, Dispatcher, Router
+import aiosqlite
+from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.filters.command import CommandObject
-from aiogram.types import BotCommand, Message, MessageEntity
+from aiogram.types import BotCommand, Message
+from aiosqlitepool import SQLiteConnectionPool
 from dotenv import load_dotenv
 
 # =========================
 # Настройки доступа (Whitelist)
 # =========================
-ALLOWED_USER_IDS = {
+ALLOWED_USER_IDS = frozenset({
     578664673,
     921799469,
     5253999365,
     824111058,
-}
-
-def is_allowed(user_id: int | None) -> bool:
-    return user_id in ALLOWED_USER_IDS if user_id is not None else False
+})
 
 # =========================
 # Конфигурация и БД
 # =========================
 
 DB_PATH = "warns.sqlite3"
+# Сколько строк выводит /allwarns за раз.
+ALLWARNS_PAGE_SIZE = 50
+
+# Тексты запросов держим в константах: sqlite3 кэширует подготовленные выражения
+# по тексту SQL, и на долгоживущем соединении каждый запрос разбирается один раз.
+_SQL_UPSERT_PARTICIPANT = """
+    INSERT INTO participants (chat_id, user_id, username, username_lower, first_name, last_name, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        username=excluded.username,
+        username_lower=excluded.username_lower,
+        first_name=excluded.first_name,
+        last_name=excluded.last_name,
+        updated_at=CURRENT_TIMESTAMP
+"""
+
+_SQL_FIND_PARTICIPANT = """
+    SELECT user_id, username, first_name, last_name
+    FROM participants
+    WHERE chat_id = ? AND username_lower = ?
+"""
+
+_SQL_ADD_WARN = """
+    INSERT INTO warns (chat_id, user_id, user_name, warn_type, reason, given_by_id, given_by_name, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Строки для /warns собираются прямо в SQL (вместе с HTML-экранированием текстовых
+# полей); оконные SUM считаются по всем строкам пользователя до LIMIT — итоги
+# и последние записи приходят одним проходом.
+_SQL_GET_WARNS_AND_COUNTS = """
+    SELECT printf(
+               '%d) %s%s (%s)%s',
+               row_number() OVER (ORDER BY created_at DESC, id DESC),
+               CASE warn_type WHEN 'hard' THEN 'Строгий' ELSE 'Обычный' END,
+               CASE WHEN given_by_name <> ''
+                    THEN ' от ' || replace(replace(replace(given_by_name, '&', '&amp;'), '<', '&lt;'), '>', '&gt;')
+                    ELSE '' END,
+               date(created_at, 'unixepoch'),
+               CASE WHEN reason <> ''
+                    THEN ' — ' || replace(replace(replace(reason, '&', '&amp;'), '<', '&lt;'), '>', '&gt;')
+                    ELSE '' END
+           ) AS line,
+           SUM(warn_type = 'warn') OVER () AS warn_cnt,
+           SUM(warn_type = 'hard') OVER () AS hard_cnt
+    FROM warns
+    WHERE chat_id = ? AND user_id = ?
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+"""
+
+_SQL_GET_COUNTS = """
+    SELECT warn_cnt, hard_cnt
+    FROM warn_totals
+    WHERE chat_id = ? AND user_id = ?
+"""
+
+_SQL_ALL_COUNTS = """
+    SELECT user_id, COALESCE(user_name, '') AS user_name, warn_cnt, hard_cnt
+    FROM warn_totals
+    WHERE chat_id = ?
+    ORDER BY (warn_cnt + hard_cnt) DESC, hard_cnt DESC
+    LIMIT ? OFFSET ?
+"""
+
+# Отдельный текст запроса на каждый вид амнистии: фильтр по типу вшит в SQL,
+# и в кэше выражений у каждого варианта своя запись.
+_SQL_AMNESTY_TEMPLATE = """
+    DELETE FROM warns
+    WHERE id IN (
+        SELECT id FROM warns
+        WHERE chat_id = ? AND user_id = ?{type_filter}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    )
+"""
 
-def db_init():
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS warns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                user_name TEXT,
-                warn_type TEXT CHECK (warn_type IN ('warn','hard')) NOT NULL,
-                reason TEXT,
-                given_by_id INTEGER,
-                given_by_name TEXT,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        conn.execute(
+_AMNESTY_SQL = {
+    "warn": _SQL_AMNESTY_TEMPLATE.format(type_filter=" AND warn_type = 'warn'"),
+    "hard": _SQL_AMNESTY_TEMPLATE.format(type_filter=" AND warn_type = 'hard'"),
+    "all": _SQL_AMNESTY_TEMPLATE.format(type_filter=""),
+}
+
+_SQL_FULL_AMNESTY = "DELETE FROM warns WHERE chat_id = ? AND user_id = ?"
+
+async def _connect() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DB_PATH, isolation_level=None)
+    # Эти PRAGMA действуют только в рамках соединения, поэтому задаём их при каждом открытии.
+    # mmap_size с запасом покрывает файл БД: чтения идут из отображённых страниц без read().
+    await conn.execute("PRAGMA busy_timeout=5000")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA cache_size=-64000")
+    await conn.execute("PRAGMA mmap_size=30000000")
+    return conn
+
+# Версия схемы хранится в PRAGMA user_version; _migrate доводит старые файлы БД до неё.
+_SCHEMA_VERSION = 2
+
+_SQL_CREATE_WARNS = """
+    CREATE TABLE IF NOT EXISTS warns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        user_name TEXT,
+        warn_type TEXT CHECK (warn_type IN ('warn','hard')) NOT NULL,
+        reason TEXT,
+        given_by_id INTEGER,
+        given_by_name TEXT,
+        created_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+    )
+"""
+
+# Сводка для /allwarns: счётчики на пользователя, которые поддерживают триггеры на warns.
+_SQL_CREATE_WARN_TOTALS = """
+    CREATE TABLE IF NOT EXISTS warn_totals (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        user_name TEXT,
+        warn_cnt INTEGER NOT NULL DEFAULT 0,
+        hard_cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, user_id)
+    )
+"""
+
+_SQL_CREATE_WARN_TOTALS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_warns_insert_totals AFTER INSERT ON warns
+    BEGIN
+        INSERT INTO warn_totals (chat_id, user_id, user_name, warn_cnt, hard_cnt)
+        VALUES (NEW.chat_id, NEW.user_id, NEW.user_name, NEW.warn_type = 'warn', NEW.warn_type = 'hard')
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            user_name=excluded.user_name,
+            warn_cnt=warn_cnt + excluded.warn_cnt,
+            hard_cnt=hard_cnt + excluded.hard_cnt;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_warns_delete_totals AFTER DELETE ON warns
+    BEGIN
+        UPDATE warn_totals
+        SET warn_cnt = warn_cnt - (OLD.warn_type = 'warn'),
+            hard_cnt = hard_cnt - (OLD.warn_type = 'hard')
+        WHERE chat_id = OLD.chat_id AND user_id = OLD.user_id;
+        DELETE FROM warn_totals
+        WHERE chat_id = OLD.chat_id AND user_id = OLD.user_id AND warn_cnt = 0 AND hard_cnt = 0;
+    END
+    """,
+)
+
+async def _migrate_created_at_to_epoch(conn: aiosqlite.Connection):
+    # До версии 1 created_at хранился ISO-строкой (TEXT); тип колонки в SQLite
+    # не меняется через ALTER, поэтому таблицу пересоздаём.
+    async with conn.execute("PRAGMA table_info(warns)") as cur:
+        columns = {row[1]: row[2] for row in await cur.fetchall()}
+    if columns.get("created_at", "").upper() != "TEXT":
+        return
+    await conn.execute("ALTER TABLE warns RENAME TO warns_old")
+    await conn.execute(_SQL_CREATE_WARNS)
+    await conn.execute(
+        """
+        INSERT INTO warns (id, chat_id, user_id, user_name, warn_type, reason, given_by_id, given_by_name, created_at)
+        SELECT id, chat_id, user_id, user_name, warn_type, reason, given_by_id, given_by_name,
+               CAST(strftime('%s', created_at) AS INTEGER)
+        FROM warns_old
+        """
+    )
+    await conn.execute("DROP TABLE warns_old")
+
+async def _migrate_fill_warn_totals(conn: aiosqlite.Connection):
+    # Версия 2: заполняем warn_totals по уже накопленным выговорам. Индекс
+    # по (chat_id, warn_type) служил только старой сводке и больше не нужен.
+    await conn.execute("DELETE FROM warn_totals")
+    await conn.execute(
+        """
+        INSERT INTO warn_totals (chat_id, user_id, user_name, warn_cnt, hard_cnt)
+        SELECT chat_id, user_id, MAX(user_name), SUM(warn_type = 'warn'), SUM(warn_type = 'hard')
+        FROM warns
+        GROUP BY chat_id, user_id
+        """
+    )
+    await conn.execute("DROP INDEX IF EXISTS idx_warns_chat_type")
+
+async def _migrate(conn: aiosqlite.Connection):
+    async with conn.execute("PRAGMA user_version") as cur:
+        (version,) = await cur.fetchone()
+    if version >= _SCHEMA_VERSION:
+        return
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        if version < 1:
+            await _migrate_created_at_to_epoch(conn)
+        if version < 2:
+            await _migrate_fill_warn_totals(conn)
+        await conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+    except BaseException:
+        await conn.execute("ROLLBACK")
+        raise
+    await conn.execute("COMMIT")
+
+async def db_init():
+    conn = await _connect()
+    try:
+        await conn.execute(_SQL_CREATE_WARNS)
+        await conn.execute(
             """
             CREATE TABLE IF NOT EXISTS participants (
                 chat_id INTEGER NOT NULL,
@@ -65,53 +254,110 @@ def db_init():
             )
             """
         )
-        conn.execute(
+        await conn.execute(
             "CREATE INDEX IF NOT EXISTS idx_participants_chat_username ON participants (chat_id, username_lower)"
         )
-
-def participant_upsert(chat_id: int, user) -> None:
+        await conn.execute(_SQL_CREATE_WARN_TOTALS)
+        # Миграции пересоздают таблицы, поэтому индексы и триггеры warns строим уже после них.
+        await _migrate(conn)
+        # Выборки по пользователю идут в порядке индекса, без временной сортировки.
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_warns_user_time ON warns (chat_id, user_id, created_at DESC, id DESC)"
+        )
+        # Выражение совпадает с ORDER BY в _SQL_ALL_COUNTS — сводка читается прямо из индекса.
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_warn_totals_chat_rank"
+            " ON warn_totals (chat_id, (warn_cnt + hard_cnt) DESC, hard_cnt DESC)"
+        )
+        for ddl in _SQL_CREATE_WARN_TOTALS_TRIGGERS:
+            await conn.execute(ddl)
+        # WAL сохраняется в самом файле БД — достаточно включить один раз; остальные
+        # PRAGMA уже выставлены в _connect().
+        await conn.execute("PRAGMA journal_mode=WAL")
+        # Обновляем статистику, чтобы планировщик выбирал новые индексы.
+        await conn.execute("ANALYZE")
+    finally:
+        await conn.close()
+
+# Действия, которые можно применить только после успешного COMMIT текущей unit_of_work
+# (например, обновить in-memory кэш). Вне транзакции — None, действия выполняются сразу.
+_after_commit: ContextVar[list[Callable[[], None]] | None] = ContextVar("_after_commit", default=None)
+
+def _on_commit(action: Callable[[], None]) -> None:
+    pending = _after_commit.get()
+    if pending is None:
+        action()
+    else:
+        pending.append(action)
+
+@asynccontextmanager
+async def unit_of_work(pool: SQLiteConnectionPool, write: bool = True):
+    """
+    Одна транзакция на апдейт: все изменения, вызванные командой, фиксируются одним COMMIT.
+    write=False — для команд, которые пишут только через participant_upsert: обычный
+    (отложенный) BEGIN берёт блокировку записи, лишь если UPSERT действительно выполнится.
+    """
+    pending: list[Callable[[], None]] = []
+    token = _after_commit.set(pending)
+    try:
+        async with pool.connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
+    finally:
+        _after_commit.reset(token)
+    for action in pending:
+        action()
+
+def _lru_put(cache: OrderedDict, key, value, max_size: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+# (chat_id, user_id) -> ((username, first_name, last_name), момент записи по time.monotonic()).
+# Пока данные не менялись и запись свежее TTL, повторный UPSERT не нужен.
+_PARTICIPANT_TTL = 300
+_PARTICIPANT_CACHE_SIZE = 10_000
+_participant_cache: OrderedDict[tuple[int, int], tuple[tuple, float]] = OrderedDict()
+
+async def participant_upsert(conn: aiosqlite.Connection, chat_id: int, user) -> None:
     if user is None:
         return
     username = user.username or None
     username_lower = (username or "").lower() or None
     first_name = user.first_name or None
     last_name = user.last_name or None
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        conn.execute(
-            """
-            INSERT INTO participants (chat_id, user_id, username, username_lower, first_name, last_name, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(chat_id, user_id) DO UPDATE SET
-                username=excluded.username,
-                username_lower=excluded.username_lower,
-                first_name=excluded.first_name,
-                last_name=excluded.last_name,
-                updated_at=excluded.updated_at
-            """,
-            (
-                chat_id, user.id, username, username_lower, first_name, last_name,
-                datetime.utcnow().isoformat(),
-            ),
-        )
+    key = (chat_id, user.id)
+    val = (username, first_name, last_name)
+    now = time.monotonic()
+    cached = _participant_cache.get(key)
+    if cached and cached[0] == val and now - cached[1] < _PARTICIPANT_TTL:
+        _participant_cache.move_to_end(key)
+        return
+    await conn.execute(
+        _SQL_UPSERT_PARTICIPANT,
+        (chat_id, user.id, username, username_lower, first_name, last_name),
+    )
+    # Строка сохранится только с COMMIT — до него кэш трогать нельзя, иначе после
+    # отката пользователь на весь TTL выпадет из participants.
+    _on_commit(lambda: _lru_put(_participant_cache, key, (val, now), _PARTICIPANT_CACHE_SIZE))
+
+async def find_participant_by_username(conn: aiosqlite.Connection, chat_id: int, username_lower: str):
+    async with conn.execute(_SQL_FIND_PARTICIPANT, (chat_id, username_lower)) as cur:
+        row = await cur.fetchone()
+    if not row:
+        return None
+    user_id, username, first_name, last_name = row
+    full_name = " ".join([x for x in [first_name, last_name] if x]) or (f"@{username}" if username else "user")
+    return SimpleNamespace(id=user_id, full_name=full_name)
 
-def find_participant_by_username(chat_id: int, username_lower: str):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            SELECT user_id, username, first_name, last_name
-            FROM participants
-            WHERE chat_id = ? AND username_lower = ?
-            """,
-            (chat_id, username_lower),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        user_id, username, first_name, last_name = row
-        full_name = " ".join([x for x in [first_name, last_name] if x]) or (f"@{username}" if username else "user")
-        return SimpleNamespace(id=user_id, full_name=full_name)
-
-def add_warn(
+async def add_warn(
+    conn: aiosqlite.Connection,
     chat_id: int,
     user_id: int,
     user_name: str,
@@ -120,185 +366,137 @@ def add_warn(
     given_by_id: int | None,
     given_by_name: str | None,
 ):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        conn.execute(
-            """
-            INSERT INTO warns (chat_id, user_id, user_name, warn_type, reason, given_by_id, given_by_name, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                chat_id,
-                user_id,
-                user_name,
-                warn_type,
-                reason or "",
-                given_by_id,
-                given_by_name,
-                datetime.utcnow().isoformat(),
-            ),
-        )
+    await conn.execute(
+        _SQL_ADD_WARN,
+        (
+            chat_id,
+            user_id,
+            user_name,
+            warn_type,
+            reason or "",
+            given_by_id,
+            given_by_name,
+            int(time.time()),
+        ),
+    )
 
-def get_user_warns(chat_id: int, user_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            SELECT id, warn_type, reason, created_at, given_by_name
-            FROM warns
-            WHERE chat_id = ? AND user_id = ?
-            ORDER BY created_at DESC, id DESC
-            """,
-            (chat_id, user_id),
-        )
-        return cur.fetchall()
+async def get_user_warns_and_counts(conn: aiosqlite.Connection, chat_id: int, user_id: int, limit: int = 20):
+    """
+    Возвращает (warn_cnt, hard_cnt, lines), где lines — готовые строки
+    не более чем для `limit` последних выговоров.
+    """
+    async with conn.execute(_SQL_GET_WARNS_AND_COUNTS, (chat_id, user_id, limit)) as cur:
+        data = await cur.fetchall()
+    if not data:
+        return 0, 0, []
+    return data[0][1], data[0][2], [row[0] for row in data]
 
-def get_user_counts(chat_id: int, user_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            SELECT warn_type, COUNT(*)
-            FROM warns
-            WHERE chat_id = ? AND user_id = ?
-            GROUP BY warn_type
-            """,
-            (chat_id, user_id),
-        )
-        data = {row[0]: row[1] for row in cur.fetchall()}
-    return data.get("warn", 0), data.get("hard", 0)
+async def get_user_counts(conn: aiosqlite.Connection, chat_id: int, user_id: int):
+    async with conn.execute(_SQL_GET_COUNTS, (chat_id, user_id)) as cur:
+        row = await cur.fetchone()
+    return row if row else (0, 0)
 
-def get_all_counts(chat_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute(
-            """
-            SELECT user_id,
-                   COALESCE(MAX(user_name), '') as user_name,
-                   SUM(CASE WHEN warn_type='warn' THEN 1 ELSE 0 END) as warn_cnt,
-                   SUM(CASE WHEN warn_type='hard' THEN 1 ELSE 0 END) as hard_cnt
-            FROM warns
-            WHERE chat_id = ?
-            GROUP BY user_id
-            ORDER BY (warn_cnt + hard_cnt) DESC, hard_cnt DESC
-            """,
-            (chat_id,),
-        )
-        return cur.fetchall()
-
-def amnesty_partial(chat_id: int, user_id: int, count: int, kind: str):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        if kind in ("warn", "hard"):
-            conn.execute(
-                """
-                DELETE FROM warns
-                WHERE id IN (
-                    SELECT id FROM warns
-                    WHERE chat_id = ? AND user_id = ? AND warn_type = ?
-                    ORDER BY created_at DESC, id DESC
-                    LIMIT ?
-                )
-                """,
-                (chat_id, user_id, kind, count),
-            )
-        else:
-            conn.execute(
-                """
-                DELETE FROM warns
-                WHERE id IN (
-                    SELECT id FROM warns
-                    WHERE chat_id = ? AND user_id = ?
-                    ORDER BY created_at DESC, id DESC
-                    LIMIT ?
-                )
-                """,
-                (chat_id, user_id, count),
-            )
+async def get_all_counts(conn: aiosqlite.Connection, chat_id: int, limit: int, offset: int = 0):
+    """
+    Асинхронный генератор строк сводки; читать его нужно, пока открыто соединение `conn`.
+    """
+    async with conn.execute(_SQL_ALL_COUNTS, (chat_id, limit, offset)) as cur:
+        async for row in cur:
+            yield row
 
-def amnesty_full(chat_id: int, user_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        conn.execute(
-            "DELETE FROM warns WHERE chat_id = ? AND user_id = ?",
-            (chat_id, user_id),
-        )
+async def amnesty_partial(conn: aiosqlite.Connection, chat_id: int, user_id: int, count: int, kind: str):
+    await conn.execute(_AMNESTY_SQL[kind], (chat_id, user_id, count))
+
+async def amnesty_full(conn: aiosqlite.Connection, chat_id: int, user_id: int):
+    await conn.execute(_SQL_FULL_AMNESTY, (chat_id, user_id))
 
 # =========================
 # Утилиты
 # =========================
 
+_MENTION_RE = re.compile(r"@\w+")
+
+# (chat_id, user_id) -> (момент проверки по time.monotonic(), является ли админом).
+# Явной инвалидации нет: снятие прав подхватится по истечении TTL.
+_ADMIN_CACHE_TTL = 60
+_ADMIN_CACHE_SIZE = 1_000
+_admin_cache: OrderedDict[tuple[int, int], tuple[float, bool]] = OrderedDict()
+
 async def is_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
+    key = (chat_id, user_id)
+    now = time.monotonic()
+    cached = _admin_cache.get(key)
+    if cached:
+        if now - cached[0] < _ADMIN_CACHE_TTL:
+            _admin_cache.move_to_end(key)
+            return cached[1]
+        del _admin_cache[key]
     try:
         member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in {"administrator", "creator"}
     except TelegramBadRequest:
         return False
+    result = member.status in {"administrator", "creator"}
+    _lru_put(_admin_cache, key, (now, result), _ADMIN_CACHE_SIZE)
+    return result
 
 def html_user_link(user_id: int, name: str | None) -> str:
-    safe = (name or "user").replace("<", "&lt;").replace(">", "&gt;")
-    return f'<a href="tg://user?id={user_id}">{safe}</a>'
+    return f'<a href="tg://user?id={user_id}">{escape(name or "user", quote=False)}</a>'
 
-def track_message_participants(message: Message):
+async def track_message_participants(conn: aiosqlite.Connection, message: Message):
     # Автор
     if message.from_user:
-        participant_upsert(message.chat.id, message.from_user)
+        await participant_upsert(conn, message.chat.id, message.from_user)
     # Адресат в ответе
     if message.reply_to_message and message.reply_to_message.from_user:
-        participant_upsert(message.chat.id, message.reply_to_message.from_user)
-
-def extract_mention_username(message: Message) -> str | None:
-    """
-    Возвращает username без '@' из последнего mention в сообщении.
-    Поддерживается обычное упоминание вида @user (entity.type == 'mention').
-    """
-    if not message.entities:
-        return None
-    text = message.text or message.caption or ""
-    mentions = []
-    for ent in message.entities:
-        if isinstance(ent, MessageEntity) and ent.type == "mention":
-            # вырезаем кусок текста по оффсету
-            mentions.append(text[ent.offset: ent.offset + ent.length])
-    if not mentions:
-        return None
-    username = mentions[-1].lstrip("@").strip()
-    return username or None
+        await participant_upsert(conn, message.chat.id, message.reply_to_message.from_user)
 
-def extract_target_user(message: Message):
+async def extract_target_user(conn: aiosqlite.Connection, message: Message):
     """
     Порядок:
     1) reply_to_message -> from_user
     2) text_mention (entity.user)
-    3) mention @username -> ищем в локальном кэше participants
+    3) последний mention @username -> ищем в локальном кэше participants
     """
     if message.reply_to_message and message.reply_to_message.from_user:
         return message.reply_to_message.from_user
 
-    if message.entities:
-        for ent in message.entities:
-            if isinstance(ent, MessageEntity) and ent.type == "text_mention" and ent.user:
-                return ent.user
-
-    uname = extract_mention_username(message)
-    if uname:
-        found = find_participant_by_username(message.chat.id, uname.lower())
-        if found:
-            return found
+    # Один проход с конца: text_mention возвращаем сразу, mention запоминаем
+    # и идём в БД, только если text_mention так и не встретился.
+    last_mention = None
+    for ent in reversed(message.entities or ()):
+        if ent.type == "text_mention" and ent.user:
+            return ent.user
+        if ent.type == "mention" and last_mention is None:
+            last_mention = ent
+
+    if last_mention:
+        text = message.text or message.caption or ""
+        uname = text[last_mention.offset: last_mention.offset + last_mention.length].lstrip("@").strip()
+        if uname:
+            found = await find_participant_by_username(conn, message.chat.id, uname.lower())
+            if found:
+                return found
     return None
 
 def clean_reason(args: str | None) -> str:
     if not args:
         return ""
     # Удаляем лишние @username из причины, чтобы не дублить адресата.
-    return re.sub(r"@\w+", "", args).strip()
+    return _MENTION_RE.sub("", args).strip()
 
 # =========================
 # Маршруты
 # =========================
 
 router = Router()
+# Whitelist проверяется на уровне роутера: чужие апдейты не доходят ни до хендлеров,
+# ни до записи участников в БД.
+router.message.filter(F.from_user.id.in_(ALLOWED_USER_IDS))
 
 @router.message(CommandStart())
-async def on_start(message: Message):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
-        return
-    track_message_participants(message)
+async def on_start(message: Message, pool: SQLiteConnectionPool):
+    async with unit_of_work(pool, write=False) as conn:
+        await track_message_participants(conn, message)
     await message.answer(
         "Привет! Я бот учёта выговоров.\n"
         "Добавь меня в группу и выдай права администратора.\n"
@@ -306,17 +504,15 @@ async def on_start(message: Message):
     )
 
 @router.message(Command("help"))
-async def on_help(message: Message):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
-        return
-    track_message_participants(message)
+async def on_help(message: Message, pool: SQLiteConnectionPool):
+    async with unit_of_work(pool, write=False) as conn:
+        await track_message_participants(conn, message)
     await message.answer(
         "<b>Команды:</b>\n"
         "• /warn [причина] @user — выговор адресату (или ответом на сообщение)\n"
         "• /hardwarn [причина] @user — строгий выговор\n"
         "• /warns [@user] — показать выговоры адресата/указанного\n"
-        "• /allwarns — сводка по всем в чате\n"
+        f"• /allwarns [страница] — сводка по всем в чате, по {ALLWARNS_PAGE_SIZE} на странице\n"
         "• /amnesty (кол-во) [warn|hard|all] @user — амнистия у адресата\n"
         "• /fullamnesty @user — полная амнистия адресату\n\n"
         "<i>Выдавать/снимать выговоры могут только админы чата.</i>",
@@ -325,12 +521,8 @@ async def on_help(message: Message):
 
 
 @router.message(Command("warn"))
-async def cmd_warn(message: Message, bot: Bot, command: CommandObject | None = None):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
-        return
-    track_message_participants(message)
-
+async def cmd_warn(message: Message, pool: SQLiteConnectionPool, bot: Bot, command: CommandObject | None = None):
+    # Проверки без БД — до транзакции, чтобы не держать блокировку на запросах к Telegram.
     if message.chat.type not in {"group", "supergroup"}:
         await message.answer("Эта команда предназначена для групп/супергрупп.")
         return
@@ -338,22 +530,26 @@ async def cmd_warn(message: Message, bot: Bot, command: CommandObject | None = N
         await message.answer("Только администраторы могут выдавать выговоры.")
         return
 
-    target = extract_target_user(message)
+    reason = clean_reason(command.args if command else None)
+
+    async with unit_of_work(pool) as conn:
+        await track_message_participants(conn, message)
+        target = await extract_target_user(conn, message)
+        if target:
+            await add_warn(
+                conn,
+                chat_id=message.chat.id,
+                user_id=target.id,
+                user_name=getattr(target, "full_name", None) or "user",
+                warn_type="warn",
+                reason=reason,
+                given_by_id=message.from_user.id,
+                given_by_name=message.from_user.full_name,
+            )
+
     if not target:
         await message.answer("Кому выговор? Сделайте команду ответом на сообщение или укажите @username.")
         return
-
-    reason = clean_reason(command.args if command else None)
-
-    add_warn(
-        chat_id=message.chat.id,
-        user_id=target.id,
-        user_name=getattr(target, "full_name", None) or "user",
-        warn_type="warn",
-        reason=reason,
-        given_by_id=message.from_user.id,
-        given_by_name=message.from_user.full_name,
-    )
     await message.answer(
         f"Выговор выдан: {html_user_link(target.id, getattr(target, 'full_name', None) or 'user')}"
         + (f"\nПричина: {reason}" if reason else ""),
@@ -361,12 +557,7 @@ async def cmd_warn(message: Message, bot: Bot, command: CommandObject | None = N
     )
 
 @router.message(Command("hardwarn"))
-async def cmd_hardwarn(message: Message, bot: Bot, command: CommandObject | None = None):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
-        return
-    track_message_participants(message)
-
+async def cmd_hardwarn(message: Message, pool: SQLiteConnectionPool, bot: Bot, command: CommandObject | None = None):
     if message.chat.type not in {"group", "supergroup"}:
         await message.answer("Эта команда предназначена для групп/супергрупп.")
         return
@@ -374,22 +565,26 @@ async def cmd_hardwarn(message: Message, bot: Bot, command: CommandObject | None
         await message.answer("Только администраторы могут выдавать строгие выговоры.")
         return
 
-    target = extract_target_user(message)
+    reason = clean_reason(command.args if command else None)
+
+    async with unit_of_work(pool) as conn:
+        await track_message_participants(conn, message)
+        target = await extract_target_user(conn, message)
+        if target:
+            await add_warn(
+                conn,
+                chat_id=message.chat.id,
+                user_id=target.id,
+                user_name=getattr(target, "full_name", None) or "user",
+                warn_type="hard",
+                reason=reason,
+                given_by_id=message.from_user.id,
+                given_by_name=message.from_user.full_name,
+            )
+
     if not target:
         await message.answer("Кому строгий выговор? Сделайте команду ответом или укажите @username.")
         return
-
-    reason = clean_reason(command.args if command else None)
-
-    add_warn(
-        chat_id=message.chat.id,
-        user_id=target.id,
-        user_name=getattr(target, "full_name", None) or "user",
-        warn_type="hard",
-        reason=reason,
-        given_by_id=message.from_user.id,
-        given_by_name=message.from_user.full_name,
-    )
     await message.answer(
         f"Строгий выговор выдан: {html_user_link(target.id, getattr(target, 'full_name', None) or 'user')}"
         + (f"\nПричина: {reason}" if reason else ""),
@@ -397,19 +592,14 @@ async def cmd_hardwarn(message: Message, bot: Bot, command: CommandObject | None
     )
 
 @router.message(Command("warns"))
-async def cmd_warns(message: Message, command: CommandObject | None = None):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
-        return
-    track_message_participants(message)
-
-    target = extract_target_user(message)
-    user = target or message.from_user
-
-    rows = get_user_warns(message.chat.id, user.id)
-    warn_cnt, hard_cnt = get_user_counts(message.chat.id, user.id)
-
-    if not rows:
+async def cmd_warns(message: Message, pool: SQLiteConnectionPool, command: CommandObject | None = None):
+    async with unit_of_work(pool, write=False) as conn:
+        await track_message_participants(conn, message)
+        target = await extract_target_user(conn, message)
+        user = target or message.from_user
+        warn_cnt, hard_cnt, warn_lines = await get_user_warns_and_counts(conn, message.chat.id, user.id)
+
+    if not warn_lines:
         await message.answer(
             f"У {html_user_link(user.id, getattr(user, 'full_name', None) or user.full_name)} нет выговоров.",
             parse_mode="HTML",
@@ -417,49 +607,74 @@ async def cmd_warns(message: Message, command: CommandObject | None = None):
         return
 
     display_name = getattr(user, "full_name", None) or user.full_name
-    lines = [
-        f"Выговоры для {html_user_link(user.id, display_name)}:",
-        f"Обычных: <b>{warn_cnt}</b> | Строгих: <b>{hard_cnt}</b>",
-        "— — —",
-    ]
-    for i, (rec_id, wtype, reason, created_at, giver) in enumerate(rows[:20], start=1):
-        tag = "Строгий" if wtype == "hard" else "Обычный"
-        who = f" от {giver}" if giver else ""
-        why = f" — {reason}" if reason else ""
-        when = created_at.split("T")[0]
-        lines.append(f"{i}) {tag}{who} ({when}){why}")
-
-    extra = f"\nИ ещё {len(rows) - 20} записей…" if len(rows) > 20 else ""
-    await message.answer("\n".join(lines) + extra, parse_mode="HTML")
+    buf = io.StringIO()
+    buf.write(f"Выговоры для {html_user_link(user.id, display_name)}:\n")
+    buf.write(f"Обычных: <b>{warn_cnt}</b> | Строгих: <b>{hard_cnt}</b>\n")
+    buf.write("— — —")
+    for line in warn_lines:
+        buf.write("\n")
+        buf.write(line)
+
+    total = warn_cnt + hard_cnt
+    if total > len(warn_lines):
+        buf.write(f"\nИ ещё {total - len(warn_lines)} записей…")
+    await message.answer(buf.getvalue(), parse_mode="HTML")
+
+# /allwarns [страница]; номер ограничен, чтобы OFFSET всегда помещался в INTEGER SQLite.
+_ALLWARNS_PAGE_ARG = re.compile(r"\d{1,6}")
 
 @router.message(Command("allwarns"))
-async def cmd_allwarns(message: Message):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
-        return
-    track_message_participants(message)
-
-    data = get_all_counts(message.chat.id)
-    if not data:
-        await message.answer("В этом чате нет ни одного выговора.")
-        return
-
-    lines = ["<b>Сводка по выговорам в чате:</b>"]
-    for user_id, user_name, warn_cnt, hard_cnt in data:
-        total = (warn_cnt or 0) + (hard_cnt or 0)
-        lines.append(
-            f"{html_user_link(user_id, user_name or 'user')} — всего: <b>{total}</b> "
-            f"(обычных: {warn_cnt or 0}, строгих: {hard_cnt or 0})"
-        )
-    await message.answer("\n".join(lines), parse_mode="HTML")
+async def cmd_allwarns(message: Message, pool: SQLiteConnectionPool, command: CommandObject | None = None):
+    args = (command.args or "").strip() if command else ""
+    page = max(int(args), 1) if _ALLWARNS_PAGE_ARG.fullmatch(args) else 1
+    offset = (page - 1) * ALLWARNS_PAGE_SIZE
+
+    buf = io.StringIO()
+    buf.write("<b>Сводка по выговорам в чате:</b>")
+    shown = 0
+    has_more = False
+    async with unit_of_work(pool, write=False) as conn:
+        await track_message_participants(conn, message)
+        # +1 строка — чтобы понять, есть ли кто-то за пределами страницы.
+        async for user_id, user_name, warn_cnt, hard_cnt in get_all_counts(
+            conn, message.chat.id, ALLWARNS_PAGE_SIZE + 1, offset
+        ):
+            if shown == ALLWARNS_PAGE_SIZE:
+                has_more = True
+                continue
+            shown += 1
+            total = (warn_cnt or 0) + (hard_cnt or 0)
+            buf.write(
+                f"\n{html_user_link(user_id, user_name or 'user')} — всего: <b>{total}</b> "
+                f"(обычных: {warn_cnt or 0}, строгих: {hard_cnt or 0})"
+            )
 
-@router.message(Command("amnesty"))
-async def cmd_amnesty(message: Message, bot: Bot, command: CommandObject | None = None):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
+    if not shown:
+        if page > 1:
+            await message.answer(f"На странице {page} никого нет.")
+        else:
+            await message.answer("В этом чате нет ни одного выговора.")
         return
-    track_message_participants(message)
 
+    if has_more:
+        buf.write(f"\nСтраница {page}. Дальше: /allwarns {page + 1}")
+    elif page > 1:
+        buf.write(f"\nСтраница {page}.")
+    await message.answer(buf.getvalue(), parse_mode="HTML")
+
+# Разбирает command.args у /amnesty: ожидается <N> [warn|hard|all] @user, упоминания
+# могут стоять где угодно. Префикс команды и упоминание бота отсекает фильтр Command.
+# N и вид амнистии должны заканчиваться пробелом или концом строки: "2.5", "3-warn"
+# отвергаются, как и раньше. N ограничено 9 цифрами, чтобы влезать в LIMIT ? —
+# длинные числа уходят в cmd_amnesty_usage.
+_AMNESTY_ARGS = re.compile(
+    r"^(?:@\w+\s+)*(\d{1,9})(?=\s|$)(?:\s+@\w+)*(?:\s+(warn|hard|all)(?=\s|$))?",
+    re.IGNORECASE,
+)
+_AMNESTY_USAGE = "Неверные аргументы.\nПримеры:\n/amnesty 2 @user\n/amnesty 3 warn @user\n/amnesty 1 hard @user"
+
+@router.message(Command("amnesty", magic=F.args.regexp(_AMNESTY_ARGS).as_("match")))
+async def cmd_amnesty(message: Message, pool: SQLiteConnectionPool, bot: Bot, match: re.Match):
     if message.chat.type not in {"group", "supergroup"}:
         await message.answer("Эта команда предназначена для групп/супергрупп.")
         return
@@ -467,44 +682,51 @@ async def cmd_amnesty(message: Message, bot: Bot, command: CommandObject | None
         await message.answer("Только администраторы могут проводить амнистию.")
         return
 
-    target = extract_target_user(message)
+    count = int(match.group(1))
+    kind = (match.group(2) or "all").lower()
+
+    async with unit_of_work(pool) as conn:
+        await track_message_participants(conn, message)
+        target = await extract_target_user(conn, message)
+        if target and count > 0:
+            await amnesty_partial(conn, message.chat.id, target.id, count, kind)
+            warn_cnt, hard_cnt = await get_user_counts(conn, message.chat.id, target.id)
+
     if not target:
         await message.answer("Кому амнистию? Сделайте команду ответом или укажите @username.")
         return
-
-    # ожидается: /amnesty <N> [warn|hard|all] @user
-    args = (command.args or "").strip() if command else ""
-    count = None
-    kind = "all"
-    if args:
-        parts = re.sub(r"@\w+", "", args).split()
-        if parts:
-            try:
-                count = int(parts[0])
-            except Exception:
-                count = None
-            if len(parts) >= 2 and parts[1].lower() in {"warn", "hard", "all"}:
-                kind = parts[1].lower()
-
-    if not count or count <= 0:
-        await message.answer("Неверные аргументы.\nПримеры:\n/amnesty 2 @user\n/amnesty 3 warn @user\n/amnesty 1 hard @user")
+    if count <= 0:
+        await message.answer(_AMNESTY_USAGE)
         return
 
-    amnesty_partial(message.chat.id, target.id, count, kind)
-    warn_cnt, hard_cnt = get_user_counts(message.chat.id, target.id)
     await message.answer(
         f"Амнистия применена к {html_user_link(target.id, getattr(target, 'full_name', None) or 'user')}: снято до {count} ({kind}).\n"
         f"Текущий остаток — обычных: <b>{warn_cnt}</b>, строгих: <b>{hard_cnt}</b>.",
         parse_mode="HTML",
     )
 
-@router.message(Command("fullamnesty"))
-async def cmd_full_amnesty(message: Message, bot: Bot):
-    if not is_allowed(message.from_user.id):
-        await message.answer("Доступ запрещён.")
+# Сюда попадает /amnesty, аргументы которого не разобрал _AMNESTY_ARGS.
+@router.message(Command("amnesty"))
+async def cmd_amnesty_usage(message: Message, pool: SQLiteConnectionPool, bot: Bot):
+    if message.chat.type not in {"group", "supergroup"}:
+        await message.answer("Эта команда предназначена для групп/супергрупп.")
+        return
+    if not await is_admin(bot, message.chat.id, message.from_user.id):
+        await message.answer("Только администраторы могут проводить амнистию.")
         return
-    track_message_participants(message)
 
+    # Как и в остальных командах: учитываем участников и сначала спрашиваем адресата.
+    async with unit_of_work(pool, write=False) as conn:
+        await track_message_participants(conn, message)
+        target = await extract_target_user(conn, message)
+
+    if not target:
+        await message.answer("Кому амнистию? Сделайте команду ответом или укажите @username.")
+        return
+    await message.answer(_AMNESTY_USAGE)
+
+@router.message(Command("fullamnesty"))
+async def cmd_full_amnesty(message: Message, pool: SQLiteConnectionPool, bot: Bot):
     if message.chat.type not in {"group", "supergroup"}:
         await message.answer("Эта команда предназначена для групп/супергрупп.")
         return
@@ -512,17 +734,28 @@ async def cmd_full_amnesty(message: Message, bot: Bot):
         await message.answer("Только администраторы могут проводить амнистию.")
         return
 
-    target = extract_target_user(message)
+    async with unit_of_work(pool) as conn:
+        await track_message_participants(conn, message)
+        target = await extract_target_user(conn, message)
+        if target:
+            await amnesty_full(conn, message.chat.id, target.id)
+
     if not target:
         await message.answer("Кому полную амнистию? Сделайте команду ответом или укажите @username.")
         return
-
-    amnesty_full(message.chat.id, target.id)
     await message.answer(
         f"Полная амнистия применена к {html_user_link(target.id, getattr(target, 'full_name', None) or 'user')}.",
         parse_mode="HTML",
     )
 
+# Подключается после основного роутера: сюда попадают только команды
+# от пользователей вне whitelist.
+denied_router = Router()
+
+@denied_router.message(Command("start", "help", "warn", "hardwarn", "warns", "allwarns", "amnesty", "fullamnesty"))
+async def on_denied(message: Message):
+    await message.answer("Доступ запрещён.")
+
 # =========================
 # Запуск
 # =========================
@@ -533,7 +766,7 @@ async def set_commands(bot: Bot):
         BotCommand(command="warn", description="Выговор (ответ/@user)"),
         BotCommand(command="hardwarn", description="Строгий выговор (ответ/@user)"),
         BotCommand(command="warns", description="Показать выговоры"),
-        BotCommand(command="allwarns", description="Сводка по всем выговорам"),
+        BotCommand(command="allwarns", description="Сводка по всем выговорам [страница]"),
         BotCommand(command="amnesty", description="Амнистия N [warn|hard|all] @user"),
         BotCommand(command="fullamnesty", description="Полная амнистия @user"),
     ]
@@ -546,13 +779,18 @@ async def main():
     if not token:
         raise RuntimeError("Укажите BOT_TOKEN в .env")
 
-    db_init()
+    await db_init()
+    # Пул долгоживущих соединений: aiogram передаёт его в хендлеры как аргумент `pool`.
+    pool = SQLiteConnectionPool(_connect)
 
     bot = Bot(token=token, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher()
-    dp.include_router(router)
-    await set_commands(bot)
-    await dp.start_polling(bot)
+    dp = Dispatcher(pool=pool)
+    dp.include_routers(router, denied_router)
+    try:
+        await set_commands(bot)
+        await dp.start_polling(bot)
+    finally:
+        await pool.close()
 
 if __name__ == "__main__":
     asyncio.run(main())